@@ -2,32 +2,101 @@
 
 import streamlit as st
 import spacy
+from spacy.matcher import PhraseMatcher
 import sqlite3
+import threading
 from datetime import datetime
 import re
 import json
+import zlib
+
+try:
+    import orjson
+    
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=str)
+    
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, default=str).encode()
+    
+    _json_loads = json.loads
+
+def _pack_note(structured_note: dict) -> bytes:
+    """Serialize a structured note into a compressed BLOB"""
+    return zlib.compress(_json_dumps(structured_note))
+
+def _unpack_note(data) -> dict:
+    """Inverse of _pack_note; also reads rows stored as plain JSON TEXT"""
+    if isinstance(data, str):
+        return json.loads(data)
+    return _json_loads(zlib.decompress(data))
+
+# Medication dosages and vitals, matched in a single scan
+_CLINICAL_PATTERN = (
+    r'(?P<med>(?P<drug>\w+)\s+(?P<dose>\d+mg))'
+    r'|bp\s+(?P<bp>\d+/\d+)'
+    r'|hr\s+(?P<hr>\d+)'
+)
+_CLINICAL_RE = re.compile(_CLINICAL_PATTERN)
+
+# Sentence boundaries: whitespace after terminal punctuation, so "38.5" and "120/80." stay intact
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Keywords that route a sentence into each SOAP section. Single words are
+# matched against the sentence's word set ("hr" must not hit "three");
+# multi-word phrases are matched as substrings.
+_SECTION_KEYWORDS = {
+    'subjective': frozenset(['presents', 'complains', 'complaining', 'complaint', 'reports', 'reported']),
+    'objective': frozenset(['vitals', 'exam', 'examination', 'examined', 'bp', 'hr']),
+    'assessment': frozenset(['assessment', 'diagnosis', 'diagnosed', 'impression']),
+    'plan': frozenset(['plan', 'plans', 'planned', 'prescribed', 'follow up'])
+}
+_SECTION_PHRASES = {
+    section: tuple(keyword for keyword in keywords if ' ' in keyword)
+    for section, keywords in _SECTION_KEYWORDS.items()
+}
+_WORD_RE = re.compile(r'\w+')
+
+# ASCII-only twins for all-ASCII notes (the usual case); they skip the Unicode
+# character tables and match exactly the same text when the input is ASCII
+_CLINICAL_RE_ASCII = re.compile(_CLINICAL_PATTERN, re.ASCII)
+_WORD_RE_ASCII = re.compile(r'\w+', re.ASCII)
+
+@st.cache_resource
+def _load_nlp():
+    """Load spaCy NLP model once per process with error handling"""
+    try:
+        # Only the tokenizer is used; excluded components are never loaded
+        return spacy.load(
+            "en_core_web_sm",
+            exclude=["tok2vec", "tagger", "parser", "senter", "attribute_ruler", "lemmatizer", "ner"]
+        )
+    except OSError:
+        st.warning("⚠️ spaCy model not found. Please run: `python -m spacy download en_core_web_sm`")
+        return None
 
 class HealthcareScribeApp:
     def __init__(self, db_path: str = 'healthcare_emr.db'):
         self.db_path = db_path
-        self.nlp = self._initialize_nlp()
+        # One connection is shared by every Streamlit session; serialize its use
+        self._lock = threading.Lock()
+        self.nlp = _load_nlp()
         self.init_database()
         self.medical_terms = self.load_medical_terminology()
     
-    def _initialize_nlp(self):
-        """Initialize spaCy NLP model with error handling"""
-        try:
-            return spacy.load("en_core_web_sm")
-        except OSError:
-            st.warning("⚠️ spaCy model not found. Please run: `python -m spacy download en_core_web_sm`")
-            return None
-    
     def init_database(self):
         """Initialize SQLite database for patient records"""
         try:
             self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
             self.cursor = self.conn.cursor()
             
+            # WAL lets readers run during writes; NORMAL syncs once per checkpoint
+            for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "busy_timeout=5000",
+                           "temp_store=MEMORY", "cache_size=-20000"):
+                self.cursor.execute(f"PRAGMA {pragma}")
+            
             # Create tables
             self.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS patients (
@@ -41,74 +110,105 @@ class HealthcareScribeApp:
                 CREATE TABLE IF NOT EXISTS visits (
                     visit_id INTEGER PRIMARY KEY AUTOINCREMENT,
                     patient_id INTEGER, visit_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    medical_specialty TEXT, subjective_note TEXT, objective_note TEXT,
-                    assessment_note TEXT, plan_note TEXT, structured_data TEXT,
+                    medical_specialty TEXT, structured_data BLOB,
                     FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
                 )
             ''')
             
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_patient ON visits(patient_id)')
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(last_name, first_name)')
+            
             self.conn.commit()
         except Exception as e:
             st.error(f"Database error: {e}")
     
     def load_medical_terminology(self):
-        """Load medical terminology"""
-        return {
+        """Load medical terminology and build the term matcher"""
+        raw_terms = {
             'symptoms': ['chest pain', 'headache', 'fever', 'cough', 'shortness of breath', 'fatigue'],
             'medications': ['ibuprofen', 'aspirin', 'claritin', 'zyrtec', 'allegra'],
             'diagnoses': ['allergic rhinitis', 'hypertension', 'diabetes', 'asthma', 'angina'],
             'procedures': ['echocardiogram', 'gastric bypass', 'endoscopy']
         }
+        terms = {
+            category: frozenset(term.lower() for term in category_terms)
+            for category, category_terms in raw_terms.items()
+        }
+        
+        # PhraseMatcher walks the token array once in Cython, case-insensitively.
+        # Each term is keyed by itself and also matches its plural ("fevers").
+        self._matcher = None
+        self._term_categories = {}
+        if self.nlp:
+            self._matcher = PhraseMatcher(self.nlp.vocab, attr="LOWER")
+            for category, category_terms in terms.items():
+                for term in category_terms:
+                    self._matcher.add(term, [self.nlp.make_doc(term), self.nlp.make_doc(term + 's')])
+                    self._term_categories[term] = category
+        
+        return terms
     
     def transcribe_audio_to_text(self, audio_file_path: str) -> str:
         """Simulate audio transcription"""
         return "Patient presents with chest pain and shortness of breath. Vitals: BP 120/80, HR 85. Assessment: Possible angina. Plan: Prescribed ibuprofen 200mg twice daily."
     
-    def extract_medical_entities(self, text: str):
-        """Extract medical entities from text"""
+    def extract_medical_entities(self, text: str, text_lower: str = None):
+        """Extract medical entities from text, reusing text_lower if given"""
         entities = {category: [] for category in self.medical_terms.keys()}
         entities.update({'vitals': [], 'dates': []})
         
         if not self.nlp:
             return entities
         
-        text_lower = text.lower()
+        if text_lower is None:
+            text_lower = text.lower()
         
         # Basic entity extraction
-        for category, terms in self.medical_terms.items():
-            for term in terms:
-                if term in text_lower:
-                    entities[category].append(term)
+        doc = self.nlp.make_doc(text)
+        for match_id, _, _ in self._matcher(doc):
+            term = self.nlp.vocab.strings[match_id]
+            category = self._term_categories[term]
+            if term not in entities[category]:
+                entities[category].append(term)
         
-        # Extract medications with dosage
-        med_pattern = r'(\w+)\s+(\d+mg)'
-        for match in re.finditer(med_pattern, text_lower):
-            entities['medications'].append(f"{match.group(1)} {match.group(2)}")
+        # Extract medications with dosage and vitals (first reading of each)
+        clinical_re = _CLINICAL_RE_ASCII if text_lower.isascii() else _CLINICAL_RE
+        bp, hr = None, None
+        for match in clinical_re.finditer(text_lower):
+            if match.lastgroup == 'med':
+                entities['medications'].append(f"{match.group('drug')} {match.group('dose')}")
+            elif match.lastgroup == 'bp':
+                bp = bp or match.group('bp')
+            elif match.lastgroup == 'hr':
+                hr = hr or match.group('hr')
         
-        # Extract vitals
-        bp_pattern = r'bp\s+(\d+/\d+)'
-        hr_pattern = r'hr\s+(\d+)'
-        
-        bp_match = re.search(bp_pattern, text_lower)
-        hr_match = re.search(hr_pattern, text_lower)
-        
-        if bp_match:
-            entities['vitals'].append(f"BP: {bp_match.group(1)}")
-        if hr_match:
-            entities['vitals'].append(f"HR: {hr_match.group(1)}")
+        if bp:
+            entities['vitals'].append(f"BP: {bp}")
+        if hr:
+            entities['vitals'].append(f"HR: {hr}")
         
         return entities
     
     def structure_clinical_note(self, text: str, medical_specialty: str):
         """Structure clinical note into SOAP format"""
-        entities = self.extract_medical_entities(text)
+        # Lowercase once; all matching below runs against this copy
+        text_lower = text.lower()
+        entities = self.extract_medical_entities(text, text_lower)
+        
+        # Simple SOAP extraction: lowering never adds or removes punctuation or
+        # whitespace, so the lowered sentences line up with the originals
+        word_re = _WORD_RE_ASCII if text_lower.isascii() else _WORD_RE
+        relevant_sentences = {section: [] for section in _SECTION_KEYWORDS}
+        for sentence, sentence_lower in zip(_SENT_RE.split(text), _SENT_RE.split(text_lower)):
+            words = set(word_re.findall(sentence_lower))
+            for section, keywords in _SECTION_KEYWORDS.items():
+                if (not keywords.isdisjoint(words)
+                        or any(phrase in sentence_lower for phrase in _SECTION_PHRASES[section])):
+                    relevant_sentences[section].append(sentence.strip())
         
-        # Simple SOAP extraction
         sections = {
-            'subjective': self._extract_section(text, ['presents', 'complains', 'reports']),
-            'objective': self._extract_section(text, ['vitals', 'exam', 'bp', 'hr']),
-            'assessment': self._extract_section(text, ['assessment', 'diagnosis', 'impression']),
-            'plan': self._extract_section(text, ['plan', 'prescribed', 'follow up'])
+            section: ' '.join(found)
+            for section, found in relevant_sentences.items()
         }
         
         return {
@@ -121,51 +221,148 @@ class HealthcareScribeApp:
             'timestamp': datetime.now().isoformat()
         }
     
-    def _extract_section(self, text: str, keywords: list):
-        """Extract section based on keywords"""
-        sentences = text.split('.')
-        relevant_sentences = []
-        
-        for sentence in sentences:
-            if any(keyword in sentence.lower() for keyword in keywords):
-                relevant_sentences.append(sentence.strip())
+    def _last_inserted_ids(self, count: int) -> list:
+        """IDs of the last `count` rows inserted in the current transaction"""
+        # AUTOINCREMENT hands out consecutive IDs inside a single write transaction
+        last_id = self.cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - count + 1, last_id + 1))
+    
+    def _insert_patients(self, rows: list) -> list:
+        """Insert (first_name, last_name, date_of_birth, gender) rows without committing"""
+        rows = list(rows)
+        self.cursor.executemany(
+            'INSERT INTO patients (first_name, last_name, date_of_birth, gender) VALUES (?, ?, ?, ?)',
+            rows
+        )
+        return self._last_inserted_ids(len(rows))
+    
+    def _insert_visits(self, rows: list) -> list:
+        """Insert (patient_id, structured_note, medical_specialty) rows without committing"""
+        # The SOAP sections live only inside the packed note; see get_patient_visits
+        params = [
+            (patient_id, medical_specialty or structured_note['medical_specialty'], _pack_note(structured_note))
+            for patient_id, structured_note, medical_specialty in rows
+        ]
         
-        return '. '.join(relevant_sentences) if relevant_sentences else ""
+        self.cursor.executemany(
+            'INSERT INTO visits (patient_id, medical_specialty, structured_data) VALUES (?, ?, ?)',
+            params
+        )
+        return self._last_inserted_ids(len(params))
+    
+    def create_patients_bulk(self, rows: list) -> list:
+        """Create many patients in a single transaction"""
+        try:
+            with self._lock, self.conn:
+                return self._insert_patients(rows)
+        except Exception as e:
+            st.error(f"Error creating patients: {e}")
+            return None
+    
+    def create_visits_bulk(self, rows: list) -> list:
+        """Create many visits in a single transaction"""
+        try:
+            with self._lock, self.conn:
+                return self._insert_visits(rows)
+        except Exception as e:
+            st.error(f"Error creating visits: {e}")
+            return None
     
     def create_patient(self, first_name: str, last_name: str, date_of_birth: str, gender: str) -> int:
         """Create new patient"""
+        patient_ids = self.create_patients_bulk([(first_name, last_name, date_of_birth, gender)])
+        return patient_ids[0] if patient_ids else None
+    
+    def create_visit(self, patient_id: int, structured_note: dict, medical_specialty: str = None) -> int:
+        """Create new visit from a note returned by structure_clinical_note"""
+        visit_ids = self.create_visits_bulk([(patient_id, structured_note, medical_specialty)])
+        return visit_ids[0] if visit_ids else None
+    
+    def get_patient_visits(self, patient_id: int) -> list:
+        """Get a patient's visits with their structured notes, oldest first"""
         try:
-            self.cursor.execute(
-                'INSERT INTO patients (first_name, last_name, date_of_birth, gender) VALUES (?, ?, ?, ?)',
-                (first_name, last_name, date_of_birth, gender)
-            )
-            self.conn.commit()
-            return self.cursor.lastrowid
+            with self._lock:
+                rows = self.conn.execute(
+                    'SELECT visit_id, visit_date, medical_specialty, structured_data '
+                    'FROM visits WHERE patient_id = ? ORDER BY visit_id',
+                    (patient_id,)
+                ).fetchall()
+            return [
+                {
+                    'visit_id': visit_id,
+                    'visit_date': visit_date,
+                    'medical_specialty': medical_specialty,
+                    'structured_note': _unpack_note(structured_data)
+                }
+                for visit_id, visit_date, medical_specialty, structured_data in rows
+            ]
         except Exception as e:
-            st.error(f"Error creating patient: {e}")
+            st.error(f"Error loading visits: {e}")
             return None
     
-    def create_visit(self, patient_id: int, transcribed_text: str, medical_specialty: str) -> int:
-        """Create new visit"""
+    def create_patients_and_visits_bulk(self, patient_rows: list, visit_rows: list) -> tuple:
+        """Create patients and their visits in a single transaction
+        
+        Each visit row is (patient_index, structured_note, medical_specialty),
+        where patient_index points into patient_rows.
+        """
         try:
-            structured_note = self.structure_clinical_note(transcribed_text, medical_specialty)
-            
-            self.cursor.execute('''
-                INSERT INTO visits (patient_id, medical_specialty, subjective_note, objective_note, 
-                                  assessment_note, plan_note, structured_data)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                patient_id, medical_specialty,
-                structured_note['subjective'], structured_note['objective'],
-                structured_note['assessment'], structured_note['plan'],
-                json.dumps(structured_note)
-            ))
-            
-            self.conn.commit()
-            return self.cursor.lastrowid
+            with self._lock, self.conn:
+                patient_ids = self._insert_patients(patient_rows)
+                visit_ids = self._insert_visits([
+                    (patient_ids[patient_index], structured_note, medical_specialty)
+                    for patient_index, structured_note, medical_specialty in visit_rows
+                ])
+            return patient_ids, visit_ids
         except Exception as e:
-            st.error(f"Error creating visit: {e}")
-            return None
+            st.error(f"Error creating patients and visits: {e}")
+            return None, None
+    
+    def create_patient_and_visit(self, first_name: str, last_name: str, date_of_birth: str, gender: str,
+                                 structured_note: dict, medical_specialty: str = None) -> tuple:
+        """Create new patient and their first visit in a single transaction"""
+        try:
+            with self._lock, self.conn:
+                [patient_id] = self._insert_patients([(first_name, last_name, date_of_birth, gender)])
+                [visit_id] = self._insert_visits([(patient_id, structured_note, medical_specialty)])
+            return patient_id, visit_id
+        except Exception as e:
+            st.error(f"Error creating patient and visit: {e}")
+            return None, None
+
+@st.cache_resource
+def _get_app():
+    """Single app instance (spaCy model and SQLite connection) shared by all sessions"""
+    return HealthcareScribeApp()
+
+# Queued visits are written automatically once this many are pending
+_AUTO_FLUSH_SIZE = 50
+
+def _queue_visit(patient_row: tuple, structured_note: dict, medical_specialty: str):
+    """Buffer a patient and visit in session state until the next flush"""
+    pending_patients = st.session_state['_pending_patients']
+    if patient_row not in pending_patients:
+        pending_patients.append(patient_row)
+    st.session_state['_pending_visits'].append(
+        (pending_patients.index(patient_row), structured_note, medical_specialty)
+    )
+
+def _flush_pending_writes(app: HealthcareScribeApp):
+    """Write all buffered patients and visits in a single transaction"""
+    pending_patients = st.session_state['_pending_patients']
+    pending_visits = st.session_state['_pending_visits']
+    if not pending_visits:
+        st.info("No pending visits to save.")
+        return
+    
+    patient_ids, visit_ids = app.create_patients_and_visits_bulk(pending_patients, pending_visits)
+    if visit_ids:
+        st.info(
+            f"💾 Saved to database - Patient IDs: {', '.join(map(str, patient_ids))}, "
+            f"Visit IDs: {', '.join(map(str, visit_ids))}"
+        )
+        pending_patients.clear()
+        pending_visits.clear()
 
 def main():
     """Main Streamlit app"""
@@ -179,10 +376,12 @@ def main():
     st.markdown("AI-powered clinical documentation assistant")
     
     # Initialize app
-    if 'app' not in st.session_state:
-        st.session_state.app = HealthcareScribeApp()
+    app = _get_app()
     
-    app = st.session_state.app
+    # Patients and visits are buffered here until _flush_pending_writes
+    if '_pending_patients' not in st.session_state:
+        st.session_state['_pending_patients'] = []
+        st.session_state['_pending_visits'] = []
     
     # Main interface
     st.header("🎤 Clinical Documentation")
@@ -215,68 +414,72 @@ def main():
             if clinical_text.strip():
                 with st.spinner("Processing clinical note..."):
                     try:
-                        # Create patient
-                        patient_id = app.create_patient(
-                            first_name, last_name, 
-                            dob.strftime("%Y-%m-%d"), gender
+                        # Process note
+                        structured_note = app.structure_clinical_note(clinical_text, specialty)
+                        
+                        # Queue for the next flush; reruns reuse an already queued patient
+                        _queue_visit(
+                            (first_name, last_name, dob.strftime("%Y-%m-%d"), gender),
+                            structured_note, specialty
                         )
                         
-                        if patient_id:
-                            # Process note
-                            structured_note = app.structure_clinical_note(clinical_text, specialty)
-                            
-                            st.success("✅ Clinical note processed successfully!")
-                            
-                            # Display SOAP note
-                            st.subheader("📋 Structured SOAP Note")
-                            
-                            soap_col1, soap_col2 = st.columns(2)
-                            
-                            with soap_col1:
-                                st.text_area(
-                                    "Subjective", 
-                                    structured_note['subjective'],
-                                    height=100,
-                                    key="subjective"
-                                )
-                                st.text_area(
-                                    "Assessment",
-                                    structured_note['assessment'],
-                                    height=100,
-                                    key="assessment"
-                                )
-                            
-                            with soap_col2:
-                                st.text_area(
-                                    "Objective",
-                                    structured_note['objective'],
-                                    height=100,
-                                    key="objective"
-                                )
-                                st.text_area(
-                                    "Plan",
-                                    structured_note['plan'],
-                                    height=100,
-                                    key="plan"
-                                )
-                            
-                            # Display extracted entities
-                            st.subheader("🔍 Extracted Medical Entities")
-                            entities = structured_note['extracted_entities']
-                            
-                            for category, items in entities.items():
-                                if items:
-                                    st.write(f"**{category.title()}:** {', '.join(items)}")
-                            
-                            # Save to database
-                            visit_id = app.create_visit(patient_id, clinical_text, specialty)
-                            if visit_id:
-                                st.info(f"💾 Saved to database - Patient ID: {patient_id}, Visit ID: {visit_id}")
+                        st.success("✅ Clinical note processed successfully!")
+                        
+                        # Display SOAP note
+                        st.subheader("📋 Structured SOAP Note")
+                        
+                        soap_col1, soap_col2 = st.columns(2)
+                        
+                        with soap_col1:
+                            st.text_area(
+                                "Subjective", 
+                                structured_note['subjective'],
+                                height=100,
+                                key="subjective"
+                            )
+                            st.text_area(
+                                "Assessment",
+                                structured_note['assessment'],
+                                height=100,
+                                key="assessment"
+                            )
+                        
+                        with soap_col2:
+                            st.text_area(
+                                "Objective",
+                                structured_note['objective'],
+                                height=100,
+                                key="objective"
+                            )
+                            st.text_area(
+                                "Plan",
+                                structured_note['plan'],
+                                height=100,
+                                key="plan"
+                            )
+                        
+                        # Display extracted entities
+                        st.subheader("🔍 Extracted Medical Entities")
+                        entities = structured_note['extracted_entities']
+                        
+                        for category, items in entities.items():
+                            if items:
+                                st.write(f"**{category.title()}:** {', '.join(items)}")
+                        
+                        if len(st.session_state['_pending_visits']) >= _AUTO_FLUSH_SIZE:
+                            _flush_pending_writes(app)
                         
                     except Exception as e:
                         st.error(f"Error processing note: {e}")
             else:
                 st.warning("Please enter clinical text to process.")
+        
+        if st.button("💾 Save to Database"):
+            _flush_pending_writes(app)
+        
+        pending_visits = len(st.session_state['_pending_visits'])
+        if pending_visits:
+            st.caption(f"📝 {pending_visits} visit(s) waiting to be saved")
     
     # Demo section
     st.header("🚀 Quick Demo")